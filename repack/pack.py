@@ -9,13 +9,11 @@ __all__ = [
 
 import sys
 import os
-import struct
 import subprocess
 import configparser
 import multiprocessing as mp
 
 import numpy as np
-import scipy.interpolate as sip
 import scipy.constants as sc
 
 from . import utils as u
@@ -57,73 +55,178 @@ def parser(cfile):
         Maximum size of chunks to read.
     ncpu: Integer
         Number of parallel CPUs to use.
+    output_format: String
+        File format of the continuum output (ascii or hdf5).
     """
-    config = configparser.ConfigParser()
+    config = configparser.RawConfigParser()
     config.read([cfile])
-    section = "REPACK"
+    section = config["REPACK"]
     # Input line-transition files:
-    lblfiles = config.get(section, "lblfiles")
-    lblfiles = lblfiles.split()
+    lblfiles = section["lblfiles"].split()
     # Database type:
-    db = config.get(section, "dbtype")
+    db = section["dbtype"]
     # Output file:
-    outfile = config.get(section, "outfile")
+    outfile = section["outfile"]
     # Partition-function file:
-    pffile = None
-    if config.has_option(section, "pffile"):
-        pffile = config.get(section, "pffile")
+    pffile = section.get("pffile")
     # Max chunk size:
-    chunksize = 5000000
-    if config.has_option(section, "chunksize"):
-        chunksize = config.getint(section, "chunksize")
+    chunksize = section.getint("chunksize", 5000000)
 
-    ncpu = 1
-    if config.has_option(section, "ncpu"):
-        ncpu = config.getint(section, "ncpu")
+    ncpu = section.getint("ncpu", 1)
     ncpu = np.clip(ncpu, 1, mp.cpu_count()-1)
 
     # Temperature sampling:
-    tmin  = config.getfloat(section, "tmin")
-    tmax  = config.getfloat(section, "tmax")
-    dtemp = config.getfloat(section, "dtemp")
+    tmin  = float(section["tmin"])
+    tmax  = float(section["tmax"])
+    dtemp = float(section["dtemp"])
 
     # Wavenumber sampling:
-    wnmin = config.getfloat(section, "wnmin")
-    wnmax = config.getfloat(section, "wnmax")
-    dwn   = config.getfloat(section, "dwn")
+    wnmin = float(section["wnmin"])
+    wnmax = float(section["wnmax"])
+    dwn   = float(section["dwn"])
 
     # Line-strength threshold:
-    sthresh = config.getfloat(section, "sthresh")
+    sthresh = float(section["sthresh"])
+
+    # Continuum output file format:
+    output_format = section.get("output_format", "ascii")
 
     return lblfiles, db, outfile, tmin, tmax, dtemp, wnmin, wnmax, dwn, \
-        sthresh, pffile, chunksize, ncpu
+        sthresh, pffile, chunksize, ncpu, output_format
+
+
+def load_chunk(lbls, chunk):
+    """
+    Read a chunk of line transitions from a set of line-transition
+    files and merge them in increasing wavenumber order.
+
+    Parameters
+    ----------
+    lbls: List of lbl objects
+        Line by line objects.
+    chunk: 2D integer ndarray
+        Initial and final indices of the chunk to read for each lbl [nlbl,2].
+
+    Returns
+    -------
+    gf: 1D float ndarray
+        Transition weighted oscillator strength (unitless).
+    Elow: 1D float ndarray
+        Transition lower-state energy (cm-1).
+    wn: 1D float ndarray
+        Transition wavenumber (cm-1).
+    iiso: 1D integer ndarray
+        Transition isotope index.
+    """
+    # Location of each LBL chunk in the merged arrays:
+    offset = np.zeros(len(lbls)+1, int)
+    offset[1:] = np.cumsum(chunk[:,1] - chunk[:,0])
+    gf   = np.empty(offset[-1], np.double)
+    Elow = np.empty(offset[-1], np.double)
+    wn   = np.empty(offset[-1], np.double)
+    iiso = np.empty(offset[-1], int)
+    for k in range(len(lbls)):
+        # Read the LBL files by chunks:
+        gfosc, el, wnumber, isoID = lbls[k].read(chunk[k])
+        gf  [offset[k]:offset[k+1]] = gfosc
+        Elow[offset[k]:offset[k+1]] = el
+        wn  [offset[k]:offset[k+1]] = wnumber
+        iiso[offset[k]:offset[k+1]] = isoID
+    # Sort by wavelength (a single sorted file needs no re-sorting):
+    if len(lbls) > 1 or np.any(wn[1:] < wn[:-1]):
+        asort = np.argsort(wn, kind='stable')
+        gf   = gf  [asort]
+        Elow = Elow[asort]
+        wn   = wn  [asort]
+        iiso = iiso[asort]
+    return gf, Elow, wn, iiso
+
+
+def flag_lines(wn, s, alphad, sthresh, frac=0.2):
+    """
+    Flag the strong lines (that stand out of the Doppler-broadened
+    profiles of the stronger neighboring lines).
+
+    Parameters
+    ----------
+    wn: 1D float ndarray
+        Transition wavenumber (cm-1), sorted in increasing order.
+    s: 1D float ndarray
+        Transition line strength.
+    alphad: 1D float ndarray
+        Transition Doppler width (cm-1).
+    sthresh: Float
+        Threshold tolerance level for weak/strong lines.
+    frac: Float
+        Fraction of the strongest lines to sort first.  The strongest
+        lines do most of the flagging, so only the ones beyond this
+        fraction that survive it as strong lines need to be sorted.
+
+    Returns
+    -------
+    flag: 1D bool ndarray
+        Strong (True) and weak (False) lines.
+    """
+    nlines = len(wn)
+    flag = np.ones(nlines, bool)
+    # Line strength per Doppler width:
+    ratio = s/alphad
+
+    k = int(frac*nlines)
+    if 0 < k < nlines:
+        # Flag first with the strongest lines (descending-strength order):
+        top = np.argpartition(ratio, nlines-k)[nlines-k:]
+        isort = top[np.argsort(-ratio[top])]
+        u.flag(flag, wn, ratio, isort, alphad, sthresh)
+        # Then continue with the remaining lines still flagged as strong:
+        rest = np.copy(flag)
+        rest[top] = False
+        rest = np.where(rest)[0]
+        isort = rest[np.argsort(-ratio[rest])]
+    else:
+        isort = np.argsort(-ratio)
+    u.flag(flag, wn, ratio, isort, alphad, sthresh)
+    return flag
 
 
-def worker(input, output):
+def worker(input, output, states, tmin, tmax, zmin, zmax, imass, iratio,
+           sthresh):
     """
     Multiprocessing worker that extracts the line-transition info
     and flags the strong/weak lines between the requested indices.
+
+    The per-run data (e.g., the Exomol states of each isotope) are
+    given once when the process starts, each task only carries the
+    lbl objects (without their bulk arrays) and the chunk indices.
     """
     for args in iter(input.get, 'STOP'):
-        wn, gf, Elow, iiso, tmin, tmax, zmin, zmax, imass, \
-            iratio, sthresh, idx = args
+        lbls, chunk, idx = args
+        for lbl in lbls:
+            if lbl.dbtype == "exomol":
+                lbl.elow, lbl.g, _ = states[lbl.iso]
+        # Read the chunk here, so that parsing runs in parallel:
+        gf, Elow, wn, iiso = load_chunk(lbls, chunk)
+
+        # Temperature-independent factors (gathered only once):
+        gfi = gf*iratio[iiso]
+        C2_Elow = c.C2*Elow
+        C2_wn   = c.C2*wn
+        # Doppler width over sqrt(T):
+        dop = wn/(100*sc.c) * np.sqrt(2.0*c.kB / (imass[iiso]*c.amu))
 
         # Low temperature line flagging:
-        s = (gf*iratio[iiso]/zmin[iiso] *
-             np.exp(-c.C2*Elow/tmin) * (1-np.exp(-c.C2*wn/tmin)))
-        alphad = wn/(100*sc.c) * np.sqrt(2.0*c.kB*tmin / (imass[iiso]*c.amu))
-        # Line-strength sorted in descending line-trength order:
-        isort = np.argsort(alphad/s)
-        flag = np.ones(len(iiso), bool)
-        u.flag(flag, wn, s/alphad, isort, alphad, sthresh)
+        invT = 1.0/tmin
+        s = gfi/zmin[iiso] * np.exp(-C2_Elow*invT)
+        s *= 1 - np.exp(-C2_wn*invT)
+        alphad = dop * np.sqrt(tmin)
+        flag = flag_lines(wn, s, alphad, sthresh)
 
         # High temperature line flagging:
-        s = (gf*iratio[iiso]/zmax[iiso] *
-             np.exp(-c.C2*Elow/tmax) * (1-np.exp(-c.C2*wn/tmax)))
-        alphad = wn/(100*sc.c) * np.sqrt(2.0*c.kB*tmax / (imass[iiso]*c.amu))
-        isort = np.argsort(alphad/s)
-        flag2 = np.ones(len(iiso), bool)
-        u.flag(flag2, wn, s/alphad, isort, alphad, sthresh)
+        invT = 1.0/tmax
+        s = gfi/zmax[iiso] * np.exp(-C2_Elow*invT)
+        s *= 1 - np.exp(-C2_wn*invT)
+        alphad = dop * np.sqrt(tmax)
+        flag2 = flag_lines(wn, s, alphad, sthresh)
 
         output.put((flag, flag2, wn, gf, Elow, iiso, idx))
 
@@ -142,7 +245,7 @@ def repack(cfile):
     # Parse configuration file:
     args = parser(cfile)
     files, dbtype, outfile, tmin, tmax, dtemp, wnmin, wnmax, dwn, \
-        sthresh, pffile, chunksize, ncpu = args
+        sthresh, pffile, chunksize, ncpu, output_format = args
 
     # Auto-detect sorted files:
     files = [f.replace('.trans','.trans.sort')
@@ -174,6 +277,18 @@ def repack(cfile):
               f"dbtype must be either hitran, exomol, or kurucz.\n{banner}\n")
         sys.exit(0)
 
+    if output_format not in ["ascii", "hdf5"]:
+        print(f"\n{banner}\n  Error: Invalid output_format ({output_format}), "
+              f"output_format must be either ascii or hdf5.\n{banner}\n")
+        sys.exit(0)
+    if output_format == "hdf5":
+        try:
+            import h5py
+        except ImportError:
+            print(f"\n{banner}\n  Error: The hdf5 output_format requires "
+                  f"the h5py package.\n{banner}\n")
+            sys.exit(0)
+
     # Parse input files:
     nfiles = len(files)
     suff, mol, isot, pf, states = [], [], [], [], []
@@ -202,13 +317,13 @@ def repack(cfile):
         sys.exit(0)
     mol = mol[0]
 
-    z = []  # Interpolator function for partition function per isotope
+    z = []  # Tabulated (temperature, partition function) per isotope
     if pffile is not None:
         # Read input partition-function file (if given):
         pftemp, partf, isotopes = u.read_pf(pffile, dbtype="pyrat")
         isotopes = list(isotopes)
         for pfvalue in partf:
-            z.append(sip.interp1d(pftemp, pfvalue, kind='slinear'))
+            z.append((pftemp, pfvalue))
     else:
         isotopes = list(np.unique(isot))
     niso = len(isotopes)
@@ -219,17 +334,9 @@ def repack(cfile):
         raise ValueError('One or more isotopes have missing isotopic ratio '
                          'or mass information in isotopes.dat file.')
 
-    s = suff[:]  # Make a copy
-    # File indices for each wavenumber set:
-    wnset = []
-    while np.size(s) != 0:
-        suffix = s[np.argmin(s)]
-        idx = []
-        for i in range(nfiles):
-            if suff[i] == suffix:
-                idx.append(i)
-                s.remove(suffix)
-        wnset.append(idx)
+    # File indices for each wavenumber set (sorted by suffix):
+    suffixes, iset = np.unique(suff, return_inverse=True)
+    wnset = [np.where(iset == k)[0].tolist() for k in range(len(suffixes))]
     nsets = len(wnset)  # Number of wavenumber sets:
 
     # Number of sets ahead to unzip:
@@ -263,7 +370,7 @@ def repack(cfile):
             # Partition function:
             if pffile is None:
                 temp, part = u.read_pf(pf[i], dbtype)
-                z.append(sip.interp1d(temp, part, kind='slinear'))
+                z.append((temp, part))
             # States:
             elow, degen = u.read_states(states[i])
             lblargs.append([elow, degen, j])
@@ -274,17 +381,34 @@ def repack(cfile):
     # Turn isotopes from string to integer data type:
     isotopes = np.asarray(isotopes, int)
 
+    # Partition functions at the flagging and continuum temperatures
+    # (linearly interpolated):
+    for ztemp, zpf in z:
+        if tmin < ztemp[0] or tmax > ztemp[-1]:
+            raise ValueError(f'The temperature range ({tmin}--{tmax} K) is '
+                'out of the bounds of the partition-function data '
+                f'({ztemp[0]}--{ztemp[-1]} K).')
+    zmin = np.array([np.interp(tmin, *z[j]) for j in range(niso)])
+    zmax = np.array([np.interp(tmax, *z[j]) for j in range(niso)])
+    Z = np.array([np.interp(temperature, *z[j]) for j in range(niso)])
+
     # Set output file names:
     lbl_out  = f"{outfile}_lbl.dat"
-    cont_out = f"{outfile}_continuum.dat"
-    # Output line-by-line file:
+    cont_ext = "h5" if output_format == "hdf5" else "dat"
+    cont_out = f"{outfile}_continuum.{cont_ext}"
+    # Output line-by-line file (records packed as u.lbl_record, '<dddi'):
     lblf = open(lbl_out, "wb")
 
     # Create queues and start worker processes:
     task_queue = mp.Queue()
     done_queue = mp.Queue()
+    wargs = (task_queue, done_queue, lblargs, tmin, tmax, zmin, zmax,
+             imass, iratio, sthresh)
     for i in range(ncpu):
-        mp.Process(target=worker, args=(task_queue, done_queue)).start()
+        mp.Process(target=worker, args=wargs).start()
+    # OpenMP threads for the continuum, which runs while the ncpu workers
+    # are still flagging the next chunks (use the remaining CPUs):
+    nthreads = max(1, mp.cpu_count() - ncpu)
 
     total_lines = 0
     # Read line-by-line files:
@@ -343,37 +467,12 @@ def repack(cfile):
                     chunk[k,n] = lbl[k].bs(
                         wnchunk[n], chunk[k,n-1], chunk[k,nchunks])
 
-        # Proccess chunks:
+        # Proccess chunks (the workers read the files and send back
+        # the merged chunk values and flags):
         for n in range(nchunks):
-            gf   = np.array([])
-            Elow = np.array([])
-            wn   = np.array([])
-            iiso = np.array([], int)
-            for k in range(len(wnset[i])):
-                # Read the LBL files by chunks:
-                gfosc, el, wnumber, isoID = lbl[k].read(chunk[k,n:n+2])
-                gf   = np.hstack([gf,   gfosc  ])
-                Elow = np.hstack([Elow, el     ])
-                wn   = np.hstack([wn,   wnumber])
-                iiso = np.hstack([iiso, isoID  ])
-            # Sort by wavelength:
-            asort = np.argsort(wn)
-            gf   = gf  [asort]
-            Elow = Elow[asort]
-            wn   = wn  [asort]
-            iiso = iiso[asort]
-
-            zmin = np.array([z[j](tmin) for j in range(niso)])
-            zmax = np.array([z[j](tmax) for j in range(niso)])
-
-            args = (wn, gf, Elow, iiso, tmin, tmax, zmin, zmax,
-                    imass, iratio, sthresh, n)
-            task_queue.put(args)
+            task_queue.put((lbl, chunk[:,n:n+2], n))
 
-        collect_wn = []
-        collect_gf = []
-        collect_Elow = []
-        collect_iiso = []
+        collect_lbl = []
         chunk_idx = []
         for n in range(nchunks):
             flag, flag2, wn, gf, Elow, iiso, idx = done_queue.get()
@@ -397,24 +496,24 @@ def repack(cfile):
                   f"  {nkept:9,d}/{ntotal:10,d} lines.\n")
 
             # Store weak lines to continuum file as function of temp:
-            for t,T in enumerate(temperature):
-                Z = np.array([z[j](T) for j in range(niso)])
-                # Line strength in cm molec-1
-                s = (c.C3 * gf*iratio[iiso]/Z[iiso] *
-                     np.exp(-c.C2*Elow/T) * (1-np.exp(-c.C2*wn/T)))
-                # Continuum opacity in cm-1 amagat-1 (instead of cm2 molec-1):
-                u.continuum(s[~flag], wn[~flag], continuum[:,t], wnspec)
+            if ntemp != 0:
+                weak = ~flag
+                # Line-strength factor (in cm) of the weak lines:
+                gfi = c.C3 * gf[weak]*iratio[iiso[weak]]
+                # Co-add line strengths (cm molec-1) at all temperatures:
+                u.tcontinuum(gfi, wn[weak], Elow[weak], iiso[weak], Z,
+                    temperature, continuum, wnspec, c.C2, int(nthreads))
             # Store strong lines to LBL data file:
-            collect_wn.append(wn[flag])
-            collect_gf.append(gf[flag])
-            collect_Elow.append(Elow[flag])
-            collect_iiso.append(iiso[flag])
+            strong = np.zeros(nkept, u.lbl_record)
+            strong['wn']   = wn[flag]
+            strong['elow'] = Elow[flag]
+            strong['gf']   = gf[flag]
+            strong['iso']  = isotopes[iiso[flag]]
+            collect_lbl.append(strong)
             chunk_idx.append(idx)
 
         for n in np.argsort(chunk_idx):
-            for wn, gf, Elow, iiso in zip(collect_wn[n], collect_gf[n],
-                    collect_Elow[n], collect_iiso[n]):
-                lblf.write(struct.pack("dddi", wn, Elow, gf, isotopes[iiso]))
+            collect_lbl[n].tofile(lblf)
 
         for k in range(len(wnset[i])):
             lbl[k].close()
@@ -425,16 +524,27 @@ def repack(cfile):
 
     # Close LBL file:
     print(f"With a threshold strength factor of {sthresh},\n"
-          f"kept a total of {lblf.tell()/struct.calcsize('dddi'):,.0f} "
+          f"kept a total of {lblf.tell()//u.lbl_record.itemsize:,.0f} "
           f"line transitions out of {total_lines:,.0f} lines.\n")
     lblf.close()
 
     for i in range(ncpu):
         task_queue.put('STOP')
 
-    if ntemp != 0:
-        # Convert from cm2 molec-1 to cm-1 amagat-1:
-        continuum *= c.N0
+    # Convert from cm2 molec-1 to cm-1 amagat-1:
+    continuum *= c.N0
+    if ntemp != 0 and output_format == "hdf5":
+        # Save Continuum data to a chunked, compressed binary file:
+        with h5py.File(cont_out, "w") as h:
+            h.attrs['species'] = mol
+            h.create_dataset('wn', data=wnspec)
+            h.create_dataset('T', data=temperature)
+            h.create_dataset('continuum', data=continuum,
+                chunks=(min(nwave,65536), ntemp), compression='lzf')
+            h['wn'].attrs['units'] = 'cm-1'
+            h['T'].attrs['units'] = 'K'
+            h['continuum'].attrs['units'] = 'cm-1 amagat-1'
+    elif ntemp != 0:
         # Save Continuum data to file:
         with open(cont_out, "w") as f:
             # Write header:
@@ -446,11 +556,10 @@ def repack(cfile):
             # Write the data:
             f.write("# Wavenumber in cm-1, opacity in cm-1 amagat-1:\n")
             f.write("@DATA\n")
-            for i in range(nwave):
-                f.write(f" {wnspec[i]:12.6f} ")
-                for j in range(ntemp):
-                    f.write(f" {continuum[i,j]:10.4e}")
-                f.write("\n")
+            table = np.zeros((nwave, ntemp+1), np.double)
+            table[:,0]  = wnspec
+            table[:,1:] = continuum
+            np.savetxt(f, table, fmt=" %12.6f "+" %10.4e"*ntemp)
     cont_msg = f" and\n  '{cont_out}'" if ntemp != 0 else ""
 
     print(f"Successfully rewriten {dbtype} line-transition info into:\n"
@@ -493,7 +602,7 @@ def sort(cfile):
     banner = 70 * ":"
     args = parser(cfile)
     files, dbtype, outfile, tmin, tmax, dtemp, wnmin, wnmax, dwn, \
-        sthresh, pffile, chunksize, ncpu = args
+        sthresh, pffile, chunksize, ncpu, output_format = args
 
     if dbtype != "exomol":
         sys.exit(0)
@@ -594,12 +703,10 @@ def sort(cfile):
         all_wn = np.concatenate(wn)
         wn_sort = np.argsort(np.argsort(all_wn))
 
-        lines = np.zeros(nlines, f'U{lbl.llen}')
-        lbl.file.seek(0)
-        for k in range(nlines):
-            lines[wn_sort[k]] = lbl.file.readline()
+        lines = np.zeros(nlines, f'S{lbl.llen}')
+        lines[wn_sort] = np.frombuffer(lbl.mm, lines.dtype, nlines)
         sort_file = lbl.lblfile.replace('trans.bz2', 'trans.sort')
-        with open(sort_file, 'w') as f:
+        with open(sort_file, 'wb') as f:
             f.writelines(lines)
 
         proc = subprocess.Popen(["bzip2", "-z", sort_file])
@@ -6,7 +6,7 @@ from .cutils    import *
 
 __all__ = (
     utilities.__all__
-  + ["flag", "continuum", "flip"]
+  + ["flag", "continuum", "tcontinuum", "flip"]
     )
 
 # Clean up top-level namespace--delete everything that isn't in __all__
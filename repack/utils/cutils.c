@@ -11,6 +11,9 @@
 /* 1D integer ndarray:                                                      */
 #define INDi(a,i) *((int    *)(PyArray_DATA(a) + i * PyArray_STRIDE(a, 0)))
 #define INDb(a,i) *((_Bool  *)(PyArray_DATA(a) + i * PyArray_STRIDE(a, 0)))
+/* 2D double ndarray:                                                       */
+#define IND2d(a,i,j) *((double *)(PyArray_DATA(a) + i * PyArray_STRIDE(a, 0) \
+                                                 + j * PyArray_STRIDE(a, 1)))
 
 
 int
@@ -78,6 +81,79 @@ static PyObject *continuum(PyObject *self, PyObject *args){
 }
 
 
+PyDoc_STRVAR(tcontinuum__doc__,
+"Compute tabulated extinction coefficient (cm2 molec-1) over a     \n\
+temperature grid by diluting line-transitions into wavenumber array.\n\
+The line strengths are evaluated on the fly for each temperature:  \n\
+   s = gfi/Z * exp(-C2*elow/T) * (1-exp(-C2*wn/T))                  \n\
+                                                                   \n\
+Parameters                                                         \n\
+----------                                                         \n\
+gfi: 1D float ndarray                                              \n\
+   Line-transition strength factor (C3*gf*isotopic ratio).         \n\
+wn: 1D float ndarray                                               \n\
+   Central wavenumber of the line transitions.                     \n\
+elow: 1D float ndarray                                             \n\
+   Lower-state energy of the line transitions.                     \n\
+iiso: 1D integer ndarray                                           \n\
+   Isotope index of the line transitions.                          \n\
+Z: 2D float ndarray                                                \n\
+   Partition function of each isotope at each temperature.         \n\
+temp: 1D float ndarray                                             \n\
+   Tabulated temperature array.                                    \n\
+cont: 2D float ndarray                                             \n\
+   Output extinction-coefficient values of shape [nwave, ntemp].   \n\
+wnspec: 1D float ndarray                                           \n\
+   Tabulated wavenumber array.                                     \n\
+C2: Float                                                          \n\
+   Second radiation constant (cm K).                               \n\
+nthreads: Integer                                                  \n\
+   Number of threads (if compiled with OpenMP).                    \n\
+");
+
+static PyObject *tcontinuum(PyObject *self, PyObject *args){
+  PyArrayObject *gfi, *wn, *elow, *iiso, *Z, *temp, *cont, *wnspec;
+  int i, j, t,               /* Auxilliary for-loop indices                 */
+      nlines, nwave, ntemp,  /* Number of lines, wavenumber, and temps      */
+      nthreads;              /* Number of OpenMP threads                    */
+  double dwn, C2, c;
+
+  /* Load inputs:                                                           */
+  if (!PyArg_ParseTuple(args, "OOOOOOOOdi", &gfi, &wn, &elow, &iiso, &Z,
+                                      &temp, &cont, &wnspec, &C2, &nthreads))
+    return NULL;
+  if (nthreads < 1)
+    nthreads = 1;
+
+  /* Get the number of lines, spectrum, and temperature-grid sizes:         */
+  nlines = (int)PyArray_DIM(wn,    0);
+  nwave  = (int)PyArray_DIM(wnspec,0);
+  ntemp  = (int)PyArray_DIM(temp,  0);
+  /* Wavenumber sampling rate:                                              */
+  dwn = INDd(wnspec,1) - INDd(wnspec,0);
+
+  /* Temperatures are independent of each other (run them in parallel     */
+  /* when compiled with OpenMP):                                            */
+  #pragma omp parallel for private(i, j, c) num_threads(nthreads)
+  for (t=0; t<ntemp; t++){
+    /* Co-add line strengths to tabulated nearest neighbor wn sample:       */
+    j = 0;
+    for (i=0; i<nwave; i++){
+      c = 0.0;
+      while (j < nlines && INDd(wn,j) < INDd(wnspec,i)+0.5*dwn){
+        c += INDd(gfi,j) / IND2d(Z,INDi(iiso,j),t)
+             * exp(-C2*INDd(elow,j)/INDd(temp,t))
+             * (1.0-exp(-C2*INDd(wn,j)/INDd(temp,t)));
+        j++;
+      }
+      /* and dilute by the wavenumber bin width:                            */
+      IND2d(cont,i,t) += c/dwn;
+    }
+  }
+  return Py_BuildValue("i", 1);
+}
+
+
 PyDoc_STRVAR(flag__doc__,
 "Flag weak from strong line-transtion lines.                \n\
                                                             \n\
@@ -90,7 +166,8 @@ wn: 1D float ndarray                                        \n\
 s: 1D float ndarray                                         \n\
    Line-transition strength per Doppler width.              \n\
 isort: 1D integer ndarray                                   \n\
-   Indices of line transitions sorted in decreasing s order.\n\
+   Indices of line transitions sorted in decreasing s order \n\
+   (only these lines are evaluated as strong-line anchors). \n\
 alphad: 1D float ndarray                                    \n\
    Doppler width of the line transitions.                   \n\
 sthreash: Float                                             \n\
@@ -100,7 +177,7 @@ sthreash: Float                                             \n\
 static PyObject *flag(PyObject *self, PyObject *args){
   PyArrayObject *flag, *wn, *s, *isort, *alphad;
   int i, j, k,              /* Auxilliary for-loop indices                  */
-      nlines, imin, imax;
+      nlines, nsort, imin, imax;
   double f, sthresh, dop;
 
   /* Load inputs:                                                           */
@@ -108,10 +185,11 @@ static PyObject *flag(PyObject *self, PyObject *args){
                                         &alphad, &sthresh))
     return NULL;
 
-  /* Get the spectrum size:                                                 */
+  /* Get the spectrum size and number of sorted lines:                      */
   nlines = (int)PyArray_DIM(s, 0);
+  nsort  = (int)PyArray_DIM(isort, 0);
   /* Evaluate the Planck function:                                          */
-  for (j=0; j<nlines; j++){
+  for (j=0; j<nsort; j++){
     i = INDi(isort,j);
     if (INDb(flag,i)){
       /* Find limits                                                        */
@@ -137,6 +215,7 @@ PyDoc_STRVAR(cutils__doc__, "Repack C-utility functions.");
 /* A list of all the methods defined by this module.                        */
 static PyMethodDef cutils_methods[] = {
     {"continuum", continuum, METH_VARARGS, continuum__doc__},
+    {"tcontinuum", tcontinuum, METH_VARARGS, tcontinuum__doc__},
     {"flag",      flag,      METH_VARARGS, flag__doc__},
     {NULL,        NULL,      0,            NULL}                /* sentinel */
 };
@@ -12,13 +12,15 @@ __all__ = [
     "read_iso",
     "get_exomol_mol",
     "read_lbl",
+    "lbl_record",
     ]
 
 import os
 import re
+import mmap
 import zipfile
-import struct
 import itertools
+import functools
 
 import numpy as np
 import scipy.constants as sc
@@ -26,6 +28,40 @@ import scipy.constants as sc
 from .. import constants as c
 
 
+# Fixed-width record layouts of the line-transition files (the itemsize
+# is set from the actual record length of each file):
+exomol_record = {
+    'names':   ['iup', 'ilo', 'A21'],
+    'formats': ['S12', 'S12', 'S10'],
+    'offsets': [    0,    13,    26],
+    }
+
+# HITRAN 2004 160-character record (par format):
+hitran_record = {
+    'names':   ['mol', 'iso',  'wn',   'S', 'A21', 'gair', 'gself',
+                'elow', 'nair', 'dair', 'vup', 'vlo', 'qup', 'qlo',
+                'ierr', 'iref', 'flag', 'g2', 'g1'],
+    'formats': [ 'S2',  'S1', 'S12', 'S10', 'S10',   'S5',    'S5',
+                 'S10',   'S4',   'S8', 'S15', 'S15', 'S15', 'S15',
+                 'S6',  'S12',   'S1', 'S7', 'S7'],
+    'offsets': [    0,     2,     3,    15,    25,     35,      40,
+                   45,     55,     59,    67,    82,    97,   112,
+                  127,   133,    145,  146,  153],
+    }
+
+kurucz_record = {
+    'names':   ['iw', 'ieli', 'ielo', 'igf'],
+    'formats': ['i4',   'i2',   'i2',  'i2'],
+    'offsets': [   0,      4,      6,     8],
+    }
+
+# Record of the repack output LBL file (little-endian and unpadded,
+# i.e., struct '<dddi', 28 bytes per line transition):
+lbl_record = np.dtype([
+    ('wn', '<f8'), ('elow', '<f8'), ('gf', '<f8'), ('iso', '<i4')],
+    align=False)
+
+
 def fopen(filename, mode="r"):
     """
     Find out file compression format (if any) and open the file.
@@ -42,7 +78,7 @@ def fopen(filename, mode="r"):
     if filename.endswith(".bz2"):
         return open(filename.replace(".bz2", ""), mode)
     elif filename.endswith(".zip"):
-        zfile = zipfile.ZipFile(filename, mode)
+        zfile = zipfile.ZipFile(filename, "r")
         # Zip files have to be unzipped to seek them:
         fname = zfile.extract(zfile.namelist()[0])
         zfile.close()
@@ -159,20 +195,40 @@ def read_pf(pffile, dbtype="exomol"):
      [1.4072e+02 1.6080e+02 1.8089e+02 ... 2.7920e+05 2.8297e+05 2.8679e+05]
      [1.6410e+03 1.8751e+03 2.1094e+03 ... 3.2217e+06 3.2652e+06 3.3092e+06]]
     """
-    # Read partition-function file:
-    with fopen(pffile) as f:
-        lines = f.readlines()
+    values = _read_pf(pffile, dbtype)
+    if values is None:
+        return None
+    # Return copies, leave the cached arrays untouched:
+    return tuple(np.copy(value) for value in values)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_pf(pffile, dbtype):
+    """
+    Cached reader for read_pf() (a file is parsed only once per
+    session).  The returned arrays are read-only.
+    """
+    values = _parse_pf(pffile, dbtype)
+    if values is not None:
+        for value in values:
+            value.flags.writeable = False
+    return values
+
 
+def _parse_pf(pffile, dbtype):
+    """
+    Parse a partition-function file, see read_pf().
+    """
     if dbtype == "exomol":
-        # Alocate outputs:
-        ntemp = len(lines)
-        temp = np.zeros(ntemp, np.double)
-        pf   = np.zeros(ntemp, np.double)
-        # Extract data:
-        for i in np.arange(ntemp):
-            temp[i], pf[i] = lines[i].split()
+        # Read partition-function file:
+        with fopen(pffile) as f:
+            temp, pf = np.loadtxt(f, usecols=(0,1), unpack=True, ndmin=2)
         return temp, pf
 
+    # Read partition-function file:
+    with fopen(pffile) as f:
+        lines = f.readlines()
+
     if dbtype == "pyrat":
         # Number of header lines (to skip later when reading the data):
         nskip = 0
@@ -222,17 +278,10 @@ def read_states(states):
     g: 1D integer ndarray
        State total statistical degeneracy.
     """
-    # Read states file:
+    # Read states file (state energy and degeneracy, incl. ns):
     with fopen(states) as f:
-        lines = f.readlines()
-    nstates = len(lines)
-    # Alocate outputs:
-    elow = np.zeros(nstates, np.double)  # State energy
-    g    = np.zeros(nstates, int)        # State degeneracy (incl. ns)
-    # Extract data:
-    for i in range(nstates):
-        elow[i], g[i] = lines[i].split()[1:3]
-    return elow, g
+        elow, g = np.loadtxt(f, usecols=(1,2), unpack=True, ndmin=2)
+    return elow, g.astype(int)
 
 
 class lbl():
@@ -254,21 +303,57 @@ class lbl():
         self.lblfile = lblfile
         self.dbtype = dbtype
 
+        # Memory-map the file (read only):
+        with fopen(lblfile, "rb") as f:
+            self.mmfile = f.name  # The actual (uncompressed) file
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.advice = None
         if dbtype == "kurucz":
-            self.file = fopen(lblfile, "rb")
             self.llen = 16
             self.ratiolog = np.log(1.0 + 1.0/2000000)
-            self.tablog = 10.0**(0.001*(np.arange(32769) - 16384))
+            self.tablog = _kurucz_tablog()
+            record = kurucz_record
         else:
-            self.file = fopen(lblfile, "r")
-            dummy = self.file.readline()
-            self.llen = self.file.tell()
-        self.file.seek(0,2)
-        self.nlines = self.file.tell() // self.llen
+            self.llen = self.mm.find(b"\n") + 1
+            record = exomol_record if dbtype == "exomol" else hitran_record
+        # Record data type to read a chunk at once:
+        self.dtype = np.dtype(dict(record, itemsize=self.llen))
+        self.nlines = len(self.mm) // self.llen
         self.elow   = elow
         self.g      = g
         self.iso    = iso  # Isotope index
 
+        # Keep the wavenumbers in memory for the binary searches
+        # (extracted by blocks to bound the temporary arrays):
+        self.advise("MADV_SEQUENTIAL")
+        nblock = 1000000
+        self.wn = np.zeros(self.nlines, np.double)
+        for i in range(0, self.nlines, nblock):
+            chunk = i, min(i+nblock, self.nlines)
+            self.wn[chunk[0]:chunk[1]] = self.readwn(chunk)
+
+
+    def __getstate__(self):
+        # Pickle (e.g., to send to a worker process) without the bulk
+        # arrays: the memory map and the Kurucz table are rebuilt when
+        # unpickling, while the wavenumber array is not needed to read().
+        # The (per-isotope) states arrays are not sent either, the
+        # receiver must set elow and g (see pack.worker()):
+        state = self.__dict__.copy()
+        del state['mm'], state['wn']
+        state.pop('tablog', None)
+        state['elow'] = state['g'] = None
+        state['advice'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        with open(self.mmfile, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.dbtype == "kurucz":
+            self.tablog = _kurucz_tablog()
+
 
     def bs(self, val, lo, hi):
         """
@@ -289,27 +374,22 @@ class lbl():
             The index of the closest wavenumber entry to val.
         """
         # Out of bounds:
-        if val <= self.getwn(0):
+        if val <= self.wn[0]:
             return 0
-        if val >= self.getwn(self.nlines-1):
+        if val >= self.wn[self.nlines-1]:
             return self.nlines-1
 
-        # End case:
-        if hi-lo <= 1:
-            if np.abs(val-self.getwn(hi)) < np.abs(val-self.getwn(lo)):
-                return hi
-            return lo
-
-        # Half it:
-        mid = int(0.5*(hi+lo))
-        if self.getwn(mid) > val:
-            return self.bs(val, lo, mid)
-        return self.bs(val, mid, hi)
+        # Bracket val between consecutive indices within lo and hi:
+        lo += int(np.searchsorted(self.wn[lo+1:hi], val, side='right'))
+        hi = min(lo+1, hi)
+        if np.abs(val-self.wn[hi]) < np.abs(val-self.wn[lo]):
+            return hi
+        return lo
 
 
     def getwn(self, index):
         """
-        Extract wavenumber from file at the requested index.
+        Extract wavenumber from database at the requested index.
 
         Parameters
         ----------
@@ -320,22 +400,59 @@ class lbl():
         wn: Float
             The wavenumber (cm-1) at position index.
         """
+        return self.wn[index]
+
+
+    def view(self, chunk):
+        """
+        Get the records of a chunk of line transitions (without copying).
+
+        Parameters
+        ----------
+        chunk: Two-element tuple
+            Initial and final indices of the chunk to read.
+
+        Returns
+        -------
+        data: 1D structured ndarray
+            The chunk records (in increasing-wavenumber order, except
+            for kurucz dbtype).
+        """
+        nlines = chunk[1] - chunk[0]
+        # Beginning of chunk:
+        if self.dbtype == "kurucz":
+            # Reverse indexing because this DB has decreasing wn:
+            offset = (self.nlines-chunk[1]) * self.llen
+        else:
+            offset = chunk[0] * self.llen
+        return np.frombuffer(self.mm, self.dtype, nlines, offset)
+
+
+    def readwn(self, chunk):
+        """
+        Extract the wavenumbers of a chunk of line transitions.
+
+        Parameters
+        ----------
+        chunk: Two-element tuple
+            Initial and final indices of the chunk to read.
+
+        Returns
+        -------
+        wn: 1D float ndarray
+            Transition wavenumber (cm-1).
+        """
+        data = self.view(chunk)
         if self.dbtype == "exomol":
-            self.file.seek(index*self.llen)
-            iup = int(self.file.read(12)) - 1
-            self.file.read(1)
-            ilo = int(self.file.read(12)) - 1
+            iup = data['iup'].astype(int) - 1
+            ilo = data['ilo'].astype(int) - 1
             return self.elow[iup] - self.elow[ilo]
 
         elif self.dbtype == "hitran":
-            self.file.seek(index*self.llen + 3)
-            return float(self.file.read(12))
+            return data['wn'].astype(np.double)
 
         elif self.dbtype == "kurucz":
-            # Note I'm reversing the indexing because this DB has decreasing wn:
-            self.file.seek((self.nlines-index-1)*self.llen)
-            # 4 = struct.calcsize("i")
-            iw = struct.unpack('i', self.file.read(4))[0]
+            iw = data['iw'][::-1].astype(int)
             return 1.0/(np.exp(iw * self.ratiolog) * c.nano)
 
 
@@ -359,21 +476,15 @@ class lbl():
         isoID: 1D integer ndarray
             isotope ID (for hitran dbtype).
         """
-        # Go to beginning of chunk:
-        self.file.seek(chunk[0]*self.llen)
-        nlines = chunk[1] - chunk[0]
+        self.advise("MADV_SEQUENTIAL")
+        # View the whole chunk at once:
+        data = self.view(chunk)
+
         # Extract info:
         if self.dbtype == "exomol":
-            iup = np.zeros(nlines, int)
-            ilo = np.zeros(nlines, int)
-            A21 = np.zeros(nlines, np.double)
-            for i in range(nlines):
-                line = self.file.readline()
-                iup[i] = line[ 0:12]
-                ilo[i] = line[13:25]
-                A21[i] = line[26:36]
-            iup -= 1
-            ilo -= 1
+            iup = data['iup'].astype(int) - 1
+            ilo = data['ilo'].astype(int) - 1
+            A21 = data['A21'].astype(np.double)
             # Compute values:
             wn   = self.elow[iup] - self.elow[ilo]
             gf   = self.g[iup] * A21 * c.C1 / (8.0*np.pi*100*sc.c) / wn**2.0
@@ -381,34 +492,20 @@ class lbl():
             isoID = np.tile(self.iso, np.size(wn))
 
         elif self.dbtype == "hitran":
-            isoID = np.zeros(nlines,       int)
-            wn    = np.zeros(nlines, np.double)
-            A21   = np.zeros(nlines, np.double)
-            Elow  = np.zeros(nlines, np.double)
-            g2    = np.zeros(nlines, np.double)
-            for i in range(nlines):
-                line = self.file.readline()
-                isoID[i] = line[  2:  3]
-                wn   [i] = line[  3: 15]
-                A21  [i] = line[ 25: 35]
-                Elow [i] = line[ 45: 55]
-                g2   [i] = line[146:153]
+            isoID = data['iso'].astype(int)
+            wn    = data['wn'].astype(np.double)
+            A21   = data['A21'].astype(np.double)
+            Elow  = data['elow'].astype(np.double)
+            g2    = data['g2'].astype(np.double)
             gf = g2 * A21 * c.C1 / (8.0*np.pi*100*sc.c) / wn**2.0
             isoID = (isoID - 1) % 10
 
         elif self.dbtype == "kurucz":
-            iw   = np.zeros(nlines, int)
-            ieli = np.zeros(nlines, np.short)
-            ielo = np.zeros(nlines, np.short)
-            igf  = np.zeros(nlines, np.short)
-            i = 0
-            while i < nlines:
-                idx = self.nlines - 1 - (chunk[0]+i)  # Reverse indexing again
-                self.file.seek(idx*self.llen)
-                # 10 = struct.calcsize("ihhh")
-                iw[i], ieli[i], ielo[i], igf[i] = struct.unpack(
-                    'ihhh', self.file.read(10))
-                i += 1
+            data = data[::-1]
+            iw   = data['iw'].astype(int)
+            ieli = data['ieli']
+            ielo = data['ielo']
+            igf  = data['igf']
             wn    = 1.0/(np.exp(iw * self.ratiolog) * c.nano)
             gf    = self.tablog[igf]
             isoID = np.abs(ieli) - 8950
@@ -417,12 +514,35 @@ class lbl():
         return gf, Elow, wn, isoID
 
 
+    def advise(self, option):
+        """
+        Set the kernel paging advice of the memory-mapped file.
+
+        Parameters
+        ----------
+        option: String
+            Name of the mmap madvise() option (e.g., 'MADV_SEQUENTIAL'
+            or 'MADV_RANDOM').  Ignored if not available in this platform.
+        """
+        if option == self.advice or not hasattr(mmap, option):
+            return
+        self.mm.madvise(getattr(mmap, option))
+        self.advice = option
+
+
     def close(self):
+        self.mm.close()
         if self.lblfile.endswith(".zip"):
             # Remove unzipped files:
             with zipfile.ZipFile(self.lblfile, "r") as zfile:
                 os.remove(zfile.namelist()[0])
-        self.file.close()
+
+
+def _kurucz_tablog():
+    """
+    Lookup table of the Kurucz log-scaled (integer) gf and Elow values.
+    """
+    return 10.0**(0.001*(np.arange(32769) - 16384))
 
 
 def wnbalance(lbls, wnmin, wnmax, targetsize, zero=0, tol=0.01):
@@ -449,19 +569,29 @@ def wnbalance(lbls, wnmin, wnmax, targetsize, zero=0, tol=0.01):
     -------
     wntarget: Float
         The wavenumber that has targetsize transitions to the left.
+        If the tolerance cannot be met (e.g., many transitions at the
+        same wavenumber), return the closest boundary once the search
+        interval collapses to the floating-point precision.
     """
-    # Middle point between wn boundaries:
-    wntarget = 0.5*(wnmax + wnmin)
-    # Number of transitions with wn < wntarget:
-    ntarget  = count(lbls, wntarget)
-
-    if np.abs(ntarget-zero - targetsize) < tol*targetsize:
-        return wntarget
-
-    elif ntarget-zero < targetsize:
-        return wnbalance(lbls, wntarget, wnmax,    targetsize, zero, tol)
-    else:
-        return wnbalance(lbls, wnmin,    wntarget, targetsize, zero, tol)
+    while True:
+        # Middle point between wn boundaries:
+        wntarget = 0.5*(wnmax + wnmin)
+        if wntarget == wnmin or wntarget == wnmax:
+            nmin = count(lbls, wnmin) - zero
+            nmax = count(lbls, wnmax) - zero
+            if np.abs(nmin - targetsize) <= np.abs(nmax - targetsize):
+                return wnmin
+            return wnmax
+        # Number of transitions with wn < wntarget:
+        ntarget  = count(lbls, wntarget)
+
+        if np.abs(ntarget-zero - targetsize) < tol*targetsize:
+            return wntarget
+
+        elif ntarget-zero < targetsize:
+            wnmin = wntarget
+        else:
+            wnmax = wntarget
 
 
 def count(lbls, wntarget):
@@ -481,7 +611,7 @@ def count(lbls, wntarget):
     """
     nwave = 0
     for lbl in lbls:
-        nwave += lbl.bs(wntarget, 0, lbl.nlines-1)
+        nwave += int(np.searchsorted(lbl.wn, wntarget))
     return nwave
 
 
@@ -515,14 +645,8 @@ def read_iso(mol, iso, dbtype="exomol", isofile=c.ROOT+"repack/isotopes.dat"):
         iiso = 2
     elif dbtype == "hitran":
         iiso = 1
-    # Read info file:
-    with open(isofile, "r") as f:
-        lines = f.readlines()
     # Get values for our molecule/isotopes:
-    for i in np.arange(len(lines)):
-        if lines[i].startswith("#") or lines[i].strip() == "":
-            continue
-        info = lines[i].split()
+    for info in _read_isofile(isofile):
         if info[0] == mol:
             if info[iiso] in iso:
                 iratio[iso.index(info[iiso])] = info[3]
@@ -530,6 +654,19 @@ def read_iso(mol, iso, dbtype="exomol", isofile=c.ROOT+"repack/isotopes.dat"):
     return iratio, imass
 
 
+@functools.lru_cache(maxsize=None)
+def _read_isofile(isofile):
+    """
+    Cached reader of an isotopes info file for read_iso(), returns
+    a tuple with the (split) entries of each non-comment line.
+    """
+    with open(isofile, "r") as f:
+        lines = f.readlines()
+    return tuple(
+        tuple(line.split()) for line in lines
+        if not (line.startswith("#") or line.strip() == ""))
+
+
 def get_exomol_mol(dbfile):
     """
     Parse an exomol file to extract the molecule and isotope name.
@@ -606,25 +743,12 @@ def read_lbl(lbl_file):
     >>> import repack.utils as u
     >>> wn, elow, gf, iiso = u.read_lbl('HCN_exomol_0.3-33um_500-3000K_lbl.dat')
     """
-    fmt = 'dddi'
-    fmtsize = struct.calcsize(fmt)
-
-    # Number of line transitions:
-    f = open(lbl_file, 'rb')
-    f.seek(0, 2)
-    nlines = f.tell() // fmtsize
-
-    # Allocate output arrays:
-    wn   = np.zeros(nlines, np.double)
-    elow = np.zeros(nlines, np.double)
-    gf   = np.zeros(nlines, np.double)
-    iiso = np.zeros(nlines, int)
-
-    # Read file:
-    f.seek(0)
-    for i in range(nlines):
-        wn[i], elow[i], gf[i], iiso[i] = struct.unpack(fmt, f.read(fmtsize))
-    f.close()
+    data = np.fromfile(lbl_file, lbl_record)
+
+    wn   = data['wn'].astype(np.double)
+    elow = data['elow'].astype(np.double)
+    gf   = data['gf'].astype(np.double)
+    iiso = data['iso'].astype(int)
 
     return wn, elow, gf, iiso
 
@@ -4,8 +4,11 @@
 import os
 import re
 import sys
+import tempfile
 import setuptools
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+from setuptools.errors import CompileError, LinkError
 from numpy import get_include
 
 topdir = os.path.dirname(os.path.realpath(__file__))
@@ -26,13 +29,56 @@ inc = [get_include()]
 eca = ['-ffast-math']
 ela = []
 
+# Optional optimization flags (compile, link), used only if the compiler
+# accepts them:
+optional_flags = [
+    (['-O3'], []),
+    (['-funroll-loops'], []),
+    (['-fopenmp'], ['-fopenmp']),
+    ]
+# Tune for the host CPU (e.g., AVX2/FMA), unless building for distribution:
+if os.environ.get('REPACK_PORTABLE') is None:
+    optional_flags.append((['-march=native'], []))
+
+
+def has_flags(compiler, compile_args, link_args):
+    """Check whether a test program compiles and links with the given flags."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'test.c')
+        with open(src, 'w') as f:
+            f.write('int main(void){return 0;}\n')
+        try:
+            objects = compiler.compile(
+                [src], output_dir=tmpdir, extra_postargs=compile_args)
+            compiler.link_executable(
+                objects, 'test', output_dir=tmpdir, extra_postargs=link_args)
+        except (CompileError, LinkError):
+            return False
+    return True
+
+
+class repack_build_ext(build_ext):
+    """Add the optional flags supported by the (unix-like) compiler."""
+    def build_extensions(self):
+        if self.compiler.compiler_type == 'unix':
+            # Math library (exp() vectorized with -ffast-math):
+            for ext in self.extensions:
+                ext.extra_link_args += ['-lm']
+            for compile_args, link_args in optional_flags:
+                if has_flags(self.compiler, compile_args, link_args):
+                    for ext in self.extensions:
+                        ext.extra_compile_args += compile_args
+                        ext.extra_link_args += link_args
+        super().build_extensions()
+
+
 extensions = []
 for cfile in files:
     e = Extension('repack.utils.'+cfile.rstrip('.c'),
                   sources=[f"{srcdir}{cfile}"],
                   include_dirs=inc,
-                  extra_compile_args=eca,
-                  extra_link_args=ela)
+                  extra_compile_args=list(eca),
+                  extra_link_args=list(ela))
     extensions.append(e)
 
 with open('README.md', 'r') as f:
@@ -48,6 +94,9 @@ setup(name         = "lbl-repack",
                      'numpy>=1.13.3',
                      'scipy>=0.17.1',
                      ],
+      extras_require = {
+                     'hdf5': ['h5py'],
+                     },
       include_package_data=True,
       license      = "MIT",
       description  = 'A line-transition data compression package.',
@@ -55,5 +104,6 @@ setup(name         = "lbl-repack",
       long_description_content_type="text/markdown",
       include_dirs = inc,
       entry_points={"console_scripts": ['repack = repack.__main__:main']},
-      ext_modules  = extensions)
+      ext_modules  = extensions,
+      cmdclass     = {'build_ext': repack_build_ext})
 
@@ -1,5 +1,8 @@
 import os
 import subprocess
+import pytest
+
+import numpy as np
 
 ROOT = os.path.realpath(os.path.dirname(__file__) + '/..') + '/'
 os.chdir(ROOT+'tests')
@@ -45,6 +48,32 @@ Successfully rewriten hitran line-transition info into:
     os.remove('data/02_3750-4000_HITEMP2010.par')
 
 
+def test_hitemp_single_zip_hdf5(capfd):
+    h5py = pytest.importorskip('h5py')
+    # ASCII output as reference (not from a previous run):
+    ascii_file = 'CO2_hitran_2.5-2.6um_500-700K_continuum.dat'
+    if os.path.exists(ascii_file):
+        os.remove(ascii_file)
+    subprocess.call('repack hitemp_repack_single_zip.cfg'.split())
+    table = np.loadtxt(ascii_file, skiprows=8)
+    subprocess.call('repack hitemp_repack_single_zip_hdf5.cfg'.split())
+    capfd = capfd.readouterr()
+    assert """With a threshold strength factor of 0.01,
+kept a total of 72,118 line transitions out of 213,769 lines.
+
+Successfully rewriten hitran line-transition info into:
+  'CO2_hitran_2.5-2.6um_500-700K_lbl.dat' and
+  'CO2_hitran_2.5-2.6um_500-700K_continuum.h5'.""" in capfd.out
+    with h5py.File('CO2_hitran_2.5-2.6um_500-700K_continuum.h5', 'r') as h:
+        assert h.attrs['species'] == 'CO2'
+        np.testing.assert_equal(h['T'][:], np.array([500.0, 600.0, 700.0]))
+        np.testing.assert_equal(h['wn'][:], np.linspace(3750.0, 4000.0, 251))
+        assert h['continuum'].shape == (251, 3)
+        continuum = h['continuum'][:]
+    # Same values as the ASCII output (to its 4-decimal precision):
+    np.testing.assert_allclose(continuum, table[:,1:], rtol=1e-4)
+
+
 def test_hitemp_two_files(capfd):
     subprocess.call(['repack', 'hitemp_repack_two.cfg'])
     capfd = capfd.readouterr()
@@ -98,3 +98,14 @@ def test_read_lbl():
     np.testing.assert_equal(np.unique(iiso),
         np.array([626, 627, 628, 636, 638, 828]))
 
+
+def test_wnbalance_degenerate_wavenumbers():
+    # Two LBLs with a block of 200 lines at exactly the same wavenumber,
+    # the tolerance cannot be met, return the closest boundary:
+    class LBL():
+        wn = np.sort(np.concatenate([
+            np.linspace(101.0, 149.0, 400),
+            np.tile(150.0, 200),
+            np.linspace(151.0, 199.0, 400)]))
+    wntarget = u.wnbalance([LBL(), LBL()], 100.0, 200.0, 1000)
+    assert wntarget == 150.0